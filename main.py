@@ -1,22 +1,94 @@
+import asyncio
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, timezone
 from typing import Optional
+from uuid import uuid4
 
-from fastapi import FastAPI, HTTPException
+from cachetools import TTLCache
+from fastapi import Depends, FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from sqlalchemy import (
-    create_engine, Column, Integer, String, DateTime, Boolean
+    case, event, select, text, update,
+    Column, Integer, String, DateTime, Boolean, LargeBinary
 )
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
 import hashlib
+import hmac
+import orjson
+import os
+import time
+
+# Optional server-side secret (max 64 bytes); turns hash_key into a MAC.
+# Can be set after licenses exist (unkeyed rows are upgraded on activation),
+# but changing a non-empty key invalidates every license hashed with it.
+LICENSE_HMAC_KEY = os.environ.get("LICENSE_HMAC_KEY", "").encode("utf-8")
+
+# Seconds to cache /activate license rows in-process (e.g. 30); 0 disables
+LICENSE_CACHE_TTL = int(os.environ.get("LICENSE_CACHE_TTL", "0"))
 
 # ---------- DB setup ----------
-DATABASE_URL = "sqlite:///./licenses.db"
+# SQLite for local use; production points this at postgresql+asyncpg://...
+DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite+aiosqlite:///./licenses.db")
+IS_SQLITE = make_url(DATABASE_URL).get_backend_name() == "sqlite"
+
+# Set to 1 when DATABASE_URL points at PgBouncer in transaction-pooling mode
+DATABASE_PGBOUNCER = os.environ.get("DATABASE_PGBOUNCER", "0") == "1"
+
+if DATABASE_PGBOUNCER:
+    # PgBouncer does the pooling. Consecutive transactions may land on
+    # different backends shared with other clients, so asyncpg's statement
+    # caches are off and every prepared statement gets a globally unique name
+    # (the default __asyncpg_stmt_N__ names collide across clients)
+    engine_options = dict(
+        poolclass=NullPool,
+        connect_args={
+            "statement_cache_size": 0,
+            "prepared_statement_cache_size": 0,
+            "prepared_statement_name_func": lambda: f"__asyncpg_{uuid4()}__",
+        },
+    )
+else:
+    engine_options = dict(
+        pool_size=20,
+        max_overflow=10,
+        pool_timeout=30,
+        pool_pre_ping=True,
+        pool_recycle=3600,
+    )
+    if IS_SQLITE:
+        engine_options["connect_args"] = {"check_same_thread": False, "timeout": 5}
+
+engine = create_async_engine(DATABASE_URL, **engine_options)
+POOL_WARMUP = 0 if DATABASE_PGBOUNCER else 5
+
+# INSERT construct with on_conflict_do_nothing() for the active backend
+dialect_insert = sqlite_insert if IS_SQLITE else pg_insert
+
+
+def _sqlite_pragmas(dbapi_conn, _):
+    # WAL lets readers run alongside the writer; NORMAL sync is safe under WAL
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA busy_timeout=5000")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA mmap_size=268435456")
+    cur.close()
+
+
+if IS_SQLITE:
+    event.listen(engine.sync_engine, "connect", _sqlite_pragmas)
 
-engine = create_engine(
-    DATABASE_URL, connect_args={"check_same_thread": False}
+
+SessionLocal = async_sessionmaker(
+    engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
 )
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
 
@@ -25,22 +97,115 @@ class License(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     license_id = Column(String, unique=True, index=True)
-    key_hash = Column(String, nullable=False)
+    key_hash = Column(LargeBinary(32), nullable=False)  # keyed BLAKE2b-256 digest
     duration_seconds = Column(Integer, nullable=False)  # 0 = perpetual
-    first_activation_at = Column(DateTime, nullable=True)
+    first_activation_at = Column(DateTime, nullable=True, index=True)
     expires_at = Column(DateTime, nullable=True)
     machine_fingerprint = Column(String, nullable=True)
     active = Column(Boolean, default=True)
 
-    # seat-based licensing
+    # seat-based licensing; used_seats is authoritative (only the gated
+    # UPDATE in activate() increments it), so seats are never re-counted
     max_seats = Column(Integer, nullable=False, default=1)
     used_seats = Column(Integer, nullable=False, default=0)
 
 
-Base.metadata.create_all(bind=engine)
+# Hot-path lookup for /activate, built once and read as plain rows
+ACTIVATE_LOOKUP = text(
+    "SELECT id, key_hash, duration_seconds, first_activation_at, expires_at,"
+    " machine_fingerprint, active, max_seats, used_seats"
+    " FROM licenses WHERE license_id = :lid"
+).columns(
+    License.id,
+    License.key_hash,
+    License.duration_seconds,
+    License.first_activation_at,
+    License.expires_at,
+    License.machine_fingerprint,
+    License.active,
+    License.max_seats,
+    License.used_seats,
+)
+
+# license_id -> ACTIVATE_LOOKUP row; entries are dropped on every write.
+# Invalidation is per process, so a cached row is only trusted for the
+# read-only "already activated on this machine" answer (see activate()).
+LIC_CACHE = TTLCache(maxsize=10_000, ttl=LICENSE_CACHE_TTL) if LICENSE_CACHE_TTL > 0 else None
+
+# license_id -> count of invalidations; a lookup only repopulates LIC_CACHE
+# if that license wasn't invalidated while it was reading, so stale rows
+# can't be re-cached
+_lic_cache_generation = {}
+
+def _create_missing_indexes(conn):
+    """create_all() skips existing tables, so add indexes introduced later."""
+    for index in License.__table__.indexes:
+        index.create(conn, checkfirst=True)
+
+
+def _migrate_hex_key_hashes(conn):
+    """Convert key_hash values stored as hex text by older versions to raw bytes."""
+    if conn.dialect.name != "sqlite":
+        return  # only SQLite databases predate the binary column
+    rows = conn.execute(
+        text("SELECT id, key_hash FROM licenses WHERE typeof(key_hash) = 'text'")
+    ).all()
+    for row_id, hex_hash in rows:
+        conn.execute(
+            text("UPDATE licenses SET key_hash = :kh WHERE id = :id"),
+            {"kh": bytes.fromhex(hex_hash), "id": row_id},
+        )
+
+
+def _create_schema(conn):
+    Base.metadata.create_all(conn, checkfirst=True)
+    _create_missing_indexes(conn)
+    _migrate_hex_key_hashes(conn)
+
+
+# Arbitrary key for the Postgres advisory lock guarding schema setup
+SCHEMA_LOCK_ID = 0x4C494353
+
+
+async def init_db():
+    """
+    Create and migrate the schema. Every worker calls this at startup, so it
+    runs under an exclusive lock and the checkfirst steps see each other's work.
+    """
+    if IS_SQLITE:
+        # pysqlite never opens a transaction for DDL, so take the
+        # database-wide write lock explicitly
+        async with engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            await conn.exec_driver_sql("BEGIN EXCLUSIVE")
+            try:
+                await conn.run_sync(_create_schema)
+            except BaseException:
+                await conn.exec_driver_sql("ROLLBACK")
+                raise
+            await conn.exec_driver_sql("COMMIT")
+    else:
+        async with engine.begin() as conn:
+            await conn.execute(text("SELECT pg_advisory_xact_lock(:k)"), {"k": SCHEMA_LOCK_ID})
+            await conn.run_sync(_create_schema)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await init_db()
+
+    # Open a few pooled connections up front so the first requests
+    # don't pay connect + PRAGMA setup on the critical path
+    warm = [await engine.connect() for _ in range(POOL_WARMUP)]
+    for conn in warm:
+        await conn.close()
+
+    yield
+    await engine.dispose()
+
 
 # ---------- FastAPI app ----------
-app = FastAPI(title="License Server")
+app = FastAPI(title="License Server", lifespan=lifespan)
 
 # ---------- Schemas ----------
 
@@ -66,16 +231,60 @@ class ActivateResponse(BaseModel):
 
 # ---------- Helpers ----------
 
-def hash_key(raw_key: str) -> str:
-    return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+# Keyed state built once; copy() skips re-absorbing the key block per call
+_KEYED_BLAKE2B = hashlib.blake2b(digest_size=32, key=LICENSE_HMAC_KEY)
+
+
+def hash_key(raw_key: str) -> bytes:
+    # Not memoized: a cache would hold plaintext keys (and every wrong guess),
+    # and copying the pre-keyed state is about as cheap as a cache lookup
+    h = _KEYED_BLAKE2B.copy()
+    h.update(raw_key.encode("utf-8"))
+    return h.digest()
+
+
+def legacy_hash_keys(raw_key: str) -> list:
+    """
+    Digests older rows may hold; a match is upgraded to hash_key() on
+    activation. Covers plain SHA-256 and, once LICENSE_HMAC_KEY is set,
+    BLAKE2b from before the key was configured.
+    """
+    raw = raw_key.encode("utf-8")
+    digests = [hashlib.sha256(raw).digest()]
+    if LICENSE_HMAC_KEY:
+        digests.append(hashlib.blake2b(raw, digest_size=32).digest())
+    return digests
+
 
+_NOW_CACHE = [0.0, None]
 
-def get_db():
-    db = SessionLocal()
-    try:
+
+def utc_now() -> datetime:
+    """
+    Current UTC time, refreshed at most every 100ms. Only for seconds-level
+    expiry checks; values written to the DB use datetime.now() directly.
+    """
+    t = time.monotonic()
+    if t - _NOW_CACHE[0] > 0.1:
+        _NOW_CACHE[:] = [t, datetime.now(timezone.utc)]
+    return _NOW_CACHE[1]
+
+
+def _invalidate_license(license_id: str):
+    if LIC_CACHE is not None:
+        _lic_cache_generation[license_id] = _lic_cache_generation.get(license_id, 0) + 1
+        LIC_CACHE.pop(license_id, None)
+
+
+def _is_reactivation(lic, machine_fingerprint: str) -> bool:
+    """True if lic is already activated and last claimed by this machine."""
+    first_use = lic.first_activation_at is None and lic.used_seats == 0
+    return not first_use and lic.machine_fingerprint == machine_fingerprint
+
+
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
 # ---------- Root (healthcheck / keep-alive) ----------
@@ -91,32 +300,34 @@ def root():
 # ---------- Admin endpoint: register generated license ----------
 
 @app.post("/admin/create", response_model=ActivateResponse)
-def admin_create_license(payload: LicenseCreate):
-    db = next(get_db())
-
+async def admin_create_license(payload: LicenseCreate, db: AsyncSession = Depends(get_db)):
     if payload.max_seats <= 0:
         raise HTTPException(status_code=400, detail="max_seats must be positive")
 
-    existing = db.query(License).filter_by(license_id=payload.license_id).first()
-    if existing:
-        raise HTTPException(status_code=400, detail="License ID already exists")
-
     key_hash = hash_key(payload.raw_key)
 
-    lic = License(
-        license_id=payload.license_id,
-        key_hash=key_hash,
-        duration_seconds=payload.duration_seconds,
-        max_seats=payload.max_seats,
-        used_seats=0
-    )
-    db.add(lic)
-    db.commit()
-    db.refresh(lic)
+    # Single INSERT ... ON CONFLICT DO NOTHING: uniqueness is enforced
+    # atomically and an existing license_id simply returns no row
+    created = (await db.execute(
+        dialect_insert(License)
+        .values(
+            license_id=payload.license_id,
+            key_hash=key_hash,
+            duration_seconds=payload.duration_seconds,
+            max_seats=payload.max_seats,
+            used_seats=0,
+        )
+        .on_conflict_do_nothing(index_elements=[License.license_id])
+        .returning(License.id)
+    )).first()
+    if created is None:
+        raise HTTPException(status_code=400, detail="License ID already exists")
+    await db.commit()
+    _invalidate_license(payload.license_id)
 
     return ActivateResponse(
         ok=True,
-        message=f"License created (max_seats={lic.max_seats})",
+        message=f"License created (max_seats={payload.max_seats})",
         expires_at=None,
         duration_seconds=payload.duration_seconds,
     )
@@ -125,46 +336,46 @@ def admin_create_license(payload: LicenseCreate):
 # ---------- Client endpoint: first activation / reuse + seats ----------
 
 @app.post("/activate", response_model=ActivateResponse)
-def activate(payload: ActivateRequest):
-    db = next(get_db())
-
-    lic = db.query(License).filter_by(license_id=payload.license_id).first()
+async def activate(payload: ActivateRequest, db: AsyncSession = Depends(get_db)):
+    lic = LIC_CACHE.get(payload.license_id) if LIC_CACHE is not None else None
+    if lic is not None and not _is_reactivation(lic, payload.machine_fingerprint):
+        # Another worker may have claimed seats since this row was cached;
+        # anything that could claim or refuse a seat re-reads the DB
+        lic = None
+    if lic is None:
+        generation = _lic_cache_generation.get(payload.license_id, 0)
+        lic = (await db.execute(ACTIVATE_LOOKUP, {"lid": payload.license_id})).first()
+        if (
+            lic is not None
+            and LIC_CACHE is not None
+            and generation == _lic_cache_generation.get(payload.license_id, 0)
+        ):
+            LIC_CACHE[payload.license_id] = lic
     if not lic or not lic.active:
         raise HTTPException(status_code=400, detail="Unknown or inactive license")
 
     # Check key
-    if lic.key_hash != hash_key(payload.raw_key):
-        raise HTTPException(status_code=400, detail="Invalid key for this License ID")
-
-    now = datetime.now(timezone.utc)
-
-    # If never activated and no seats used yet
-    if lic.first_activation_at is None and lic.used_seats == 0:
-        if lic.used_seats >= lic.max_seats:
-            raise HTTPException(status_code=400, detail="Max seats reached for this License ID")
-
-        lic.first_activation_at = now
-        if lic.duration_seconds == 0:
-            lic.expires_at = None
-        else:
-            lic.expires_at = now + timedelta(seconds=lic.duration_seconds)
-
-        lic.machine_fingerprint = payload.machine_fingerprint
-        lic.used_seats = 1
-        db.commit()
-        db.refresh(lic)
-
-        return ActivateResponse(
-            ok=True,
-            message="Activated (first use, seat 1)",
-            expires_at=lic.expires_at,
-            duration_seconds=lic.duration_seconds,
+    key_hash = hash_key(payload.raw_key)
+    if not hmac.compare_digest(lic.key_hash, key_hash):
+        if not any(
+            hmac.compare_digest(lic.key_hash, legacy)
+            for legacy in legacy_hash_keys(payload.raw_key)
+        ):
+            raise HTTPException(status_code=400, detail="Invalid key for this License ID")
+
+        await db.execute(
+            update(License)
+            .where(License.id == lic.id)
+            .values(key_hash=key_hash)
+            .execution_options(synchronize_session=False)
         )
+        await db.commit()
+        _invalidate_license(payload.license_id)
 
-    # Already activated at least once
-    # Same machine trying again
-    if lic.machine_fingerprint == payload.machine_fingerprint:
-        if lic.expires_at and lic.expires_at <= now:
+    # Same machine trying again (only meaningful once activated)
+    if _is_reactivation(lic, payload.machine_fingerprint):
+        # Stored datetimes come back naive but are always UTC
+        if lic.expires_at and lic.expires_at.replace(tzinfo=timezone.utc) <= utc_now():
             raise HTTPException(status_code=400, detail="License expired")
 
         return ActivateResponse(
@@ -174,87 +385,152 @@ def activate(payload: ActivateRequest):
             duration_seconds=lic.duration_seconds,
         )
 
-    # Different machine trying to use this License ID
-    if lic.used_seats >= lic.max_seats:
+    # Claim a seat in a single UPDATE gated on used_seats < max_seats so two
+    # concurrent activations can never overshoot max_seats.
+    # Columns are TIMESTAMP WITHOUT TIME ZONE, so store naive UTC
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    if lic.duration_seconds == 0:
+        new_expires_at = None
+    else:
+        new_expires_at = now + timedelta(seconds=lic.duration_seconds)
+
+    never_activated = License.first_activation_at.is_(None)
+    claimed = (await db.execute(
+        update(License)
+        .where(License.id == lic.id, License.used_seats < License.max_seats)
+        .values(
+            used_seats=License.used_seats + 1,
+            machine_fingerprint=payload.machine_fingerprint,
+            first_activation_at=case((never_activated, now), else_=License.first_activation_at),
+            expires_at=case((never_activated, new_expires_at), else_=License.expires_at),
+        )
+        .returning(License.used_seats, License.max_seats, License.expires_at)
+        .execution_options(synchronize_session=False)
+    )).first()
+    if claimed is None:
+        await db.rollback()
         raise HTTPException(status_code=400, detail="Max seats reached for this License ID")
 
-    # Allow new machine seat
-    lic.used_seats += 1
-    lic.machine_fingerprint = payload.machine_fingerprint
+    await db.commit()
+    _invalidate_license(payload.license_id)
 
-    # If somehow first_activation_at is still None, set it now
-    if lic.first_activation_at is None:
-        lic.first_activation_at = now
-        if lic.duration_seconds == 0:
-            lic.expires_at = None
-        else:
-            lic.expires_at = now + timedelta(seconds=lic.duration_seconds)
-
-    db.commit()
-    db.refresh(lic)
+    if claimed.used_seats == 1:
+        message = "Activated (first use, seat 1)"
+    else:
+        message = f"Activated on another machine (seat {claimed.used_seats}/{claimed.max_seats})"
 
     return ActivateResponse(
         ok=True,
-        message=f"Activated on another machine (seat {lic.used_seats}/{lic.max_seats})",
-        expires_at=lic.expires_at,
+        message=message,
+        expires_at=claimed.expires_at,
         duration_seconds=lic.duration_seconds,
     )
 
 
 # ---------- Admin View Endpoints ----------
 
-@app.get("/admin/licenses")
-def view_all_licenses():
-    """View all licenses in database"""
-    db = next(get_db())
-
-    all_licenses = db.query(License).all()
-
-    result = []
-    for lic in all_licenses:
-        result.append({
-            "id": lic.id,
-            "license_id": lic.license_id,
-            "duration_seconds": lic.duration_seconds,
-            "first_activation_at": lic.first_activation_at.isoformat() if lic.first_activation_at else None,
-            "expires_at": lic.expires_at.isoformat() if lic.expires_at else None,
-            "machine_fingerprint": lic.machine_fingerprint[:20] + "..." if lic.machine_fingerprint else None,
-            "active": lic.active,
-            "max_seats": lic.max_seats,
-            "used_seats": lic.used_seats,
-        })
+def _license_row_to_dict(lic):
+    return {
+        "id": lic.id,
+        "license_id": lic.license_id,
+        "duration_seconds": lic.duration_seconds,
+        "first_activation_at": lic.first_activation_at,
+        "expires_at": lic.expires_at,
+        "machine_fingerprint": lic.machine_fingerprint[:20] + "..." if lic.machine_fingerprint else None,
+        "active": lic.active,
+        "max_seats": lic.max_seats,
+        "used_seats": lic.used_seats,
+    }
 
+
+def _activation_row_to_dict(lic):
     return {
-        "total": len(result),
-        "licenses": result
+        "license_id": lic.license_id,
+        "activated_at": lic.first_activation_at,
+        "expires_at": lic.expires_at or "PERPETUAL",
+        "machine": lic.machine_fingerprint[:20] + "..." if lic.machine_fingerprint else None,
+        "active": lic.active,
+        "max_seats": lic.max_seats,
+        "used_seats": lic.used_seats,
     }
 
 
+async def _stream_json_list(stmt, list_key, total_key, row_to_dict):
+    """
+    Yield {"<list_key>": [...], "<total_key>": N} chunk by chunk, fetching
+    rows through a server-side cursor so memory stays flat.
+    """
+    async with SessionLocal() as db:
+        result = await db.stream(stmt.execution_options(yield_per=1000))
+        yield b'{"%s":[' % list_key.encode()
+        total = 0
+        async for row in result:
+            if total:
+                yield b","
+            # orjson serializes datetimes natively, no per-field isoformat()
+            yield orjson.dumps(row_to_dict(row))
+            total += 1
+        yield b'],"%s":%d}' % (total_key.encode(), total)
+
+
+@app.get("/admin/licenses")
+async def view_all_licenses():
+    """View all licenses in database"""
+    # Plain column rows: skips key_hash and ORM identity-map bookkeeping
+    stmt = select(
+        License.id,
+        License.license_id,
+        License.duration_seconds,
+        License.first_activation_at,
+        License.expires_at,
+        License.machine_fingerprint,
+        License.active,
+        License.max_seats,
+        License.used_seats,
+    )
+    return StreamingResponse(
+        _stream_json_list(stmt, "licenses", "total", _license_row_to_dict),
+        media_type="application/json",
+    )
+
+
 @app.get("/admin/activations")
-def view_activations():
+async def view_activations():
     """View only activated licenses"""
-    db = next(get_db())
-
-    activated = db.query(License).filter(License.first_activation_at.isnot(None)).all()
-
-    result = []
-    for lic in activated:
-        result.append({
-            "license_id": lic.license_id,
-            "activated_at": lic.first_activation_at.isoformat(),
-            "expires_at": lic.expires_at.isoformat() if lic.expires_at else "PERPETUAL",
-            "machine": lic.machine_fingerprint[:20] + "..." if lic.machine_fingerprint else None,
-            "active": lic.active,
-            "max_seats": lic.max_seats,
-            "used_seats": lic.used_seats,
-        })
-
-    return {
-        "total_activated": len(result),
-        "activations": result
-    }
+    stmt = select(
+        License.license_id,
+        License.first_activation_at,
+        License.expires_at,
+        License.machine_fingerprint,
+        License.active,
+        License.max_seats,
+        License.used_seats,
+    ).filter(License.first_activation_at.isnot(None))
+    return StreamingResponse(
+        _stream_json_list(stmt, "activations", "total_activated", _activation_row_to_dict),
+        media_type="application/json",
+    )
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="127.0.0.1", port=8000)
+
+    async def _prepare_db():
+        await init_db()
+        await engine.dispose()
+
+    # Set up the schema once before forking; each worker's own init_db()
+    # then finds it ready (and is lock-protected if started some other way)
+    asyncio.run(_prepare_db())
+
+    # "auto" picks uvloop + httptools when installed (uvicorn[standard]);
+    # SQLite in WAL mode lets the worker processes read concurrently
+    uvicorn.run(
+        "main:app",
+        host=os.environ.get("HOST", "127.0.0.1"),
+        port=int(os.environ.get("PORT", "8000")),
+        workers=int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        loop="auto",
+        http="auto",
+        log_level="warning",
+    )